@@ -1,19 +1,41 @@
+import asyncio
+import copy
 import os
-import json
 import logging
-from typing import Any, Dict, List, Optional
+import re
+import time
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple
 
 import discord
+import httpx
+import ijson
+import json_repair
+import msgspec
+from cachetools import TTLCache
 from discord.ext import commands
-from openai import OpenAI
+from openai import APIError, AsyncOpenAI
+
+logger = logging.getLogger(__name__)
 
 # ========= Config =========
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+# Max OpenAI requests in flight; size from your tier, roughly RPM / 60 * average latency in seconds
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "20"))
+# Discord allows ~5 message edits per 5s; stay under that while streaming
+EDIT_INTERVAL = 1.0
 # Comma-separated channel IDs that the bot should listen in, e.g. "123,456"
-WATCH_CHANNEL_IDS = {
+WATCH_CHANNEL_IDS = frozenset(
     int(x.strip()) for x in os.getenv("WATCH_CHANNEL_IDS", "").split(",") if x.strip().isdigit()
-}
+)
+
+# Obvious chatter that never needs OpenAI: messages with no letters or digits (emoji, punctuation)
+# and bare greetings/reactions. Everything else goes to the model, which handles non-food text fine.
+CHATTER = re.compile(
+    r"\W*(?:(?:hi|hey|hello|yo|sup|gm|gn|bye|thanks?|thank you|thx|ty|ok(?:ay)?|k"
+    r"|lol|lmao|ha(?:ha)+|nice|cool|yes|yep|no|nope)\W*)?",
+    re.IGNORECASE,
+)
 
 if not DISCORD_TOKEN:
     raise SystemExit("Missing DISCORD_TOKEN")
@@ -25,10 +47,31 @@ if not WATCH_CHANNEL_IDS:
 # ========= Discord setup =========
 intents = discord.Intents.default()
 intents.message_content = True  # required to read text content
-bot = commands.Bot(command_prefix="!", intents=intents)
+# we never look at typing or reactions; don't have the gateway send them
+intents.typing = False
+intents.reactions = False
+
+
+class NutritionBot(commands.Bot):
+    async def close(self) -> None:
+        await super().close()
+        await http_client.aclose()
+
+
+bot = NutritionBot(command_prefix="!", intents=intents)
 
 # ========= OpenAI client =========
-client = OpenAI(api_key=OPENAI_API_KEY)
+# One keep-alive pool for the whole process so calls reuse warm TLS connections.
+# Per-request options go as kwargs to create(); avoid .with_options() on hot paths.
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=200),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+)
+# the SDK already retries 429s/5xx with exponential backoff (honouring Retry-After)
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=4)
+# back-pressure: bursts wait here on the loop instead of piling onto the API
+OPENAI_SEM = asyncio.Semaphore(OPENAI_CONCURRENCY)
 
 SYSTEM_PROMPT = (
     "You are a precise nutrition assistant for calorie and macro calculations. "
@@ -98,138 +141,379 @@ JSON_SCHEMA: Dict[str, Any] = {
     "strict": True
 }
 
-def call_openai_for_nutrition(user_text: str) -> dict:
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": user_text},
-        ],
-        tools=[{
-            "type": "function",
-            "function": {
-                "name": "nutrition_output",
-                "description": "Return calories/macros or a macro plan as structured JSON.",
-                "parameters": JSON_SCHEMA["schema"],  # reuse your schema object
-            },
-        }],
-        # force the model to use our function (structured output)
-        tool_choice={"type": "function", "function": {"name": "nutrition_output"}},
-        temperature=0.2,
-    )
+# Built once and passed as-is on every request instead of rebuilding the nested literal per call.
+# These stay plain dicts: the SDK JSON-encodes them, and a MappingProxyType wouldn't serialize.
+NUTRITION_TOOLS: List[Dict[str, Any]] = [{
+    "type": "function",
+    "function": {
+        "name": "nutrition_output",
+        "description": "Return calories/macros or a macro plan as structured JSON.",
+        "parameters": JSON_SCHEMA["schema"],  # reuse your schema object
+    },
+}]
+# force the model to use our function (structured output)
+NUTRITION_TOOL_CHOICE: Dict[str, Any] = {"type": "function", "function": {"name": "nutrition_output"}}
+# the Responses fallback gets the same schema as structured output, so its reply decodes into Payload
+FALLBACK_TEXT_FORMAT: Dict[str, Any] = {
+    "format": {"type": "json_schema", "name": JSON_SCHEMA["name"], "schema": JSON_SCHEMA["schema"]},
+}
+
+
+# Typed mirror of JSON_SCHEMA["schema"]: msgspec decodes and validates the model's JSON in one pass,
+# and the embed code reads attributes with defaults instead of chains of dict.get(...).
+# The tool isn't sent with `strict`, so the model may emit null for any optional field; those decode.
+_MACRO_FIELDS = frozenset({"calories_kcal", "protein_g", "carbs_g", "fat_g"})
+
+
+class _Macros(msgspec.Struct):
+    def __post_init__(self) -> None:
+        # a null macro (one the model couldn't estimate) reads as 0, like a missing one
+        for name in _MACRO_FIELDS.intersection(self.__struct_fields__):
+            if getattr(self, name) is None:
+                setattr(self, name, 0)
+
+
+class Item(_Macros):
+    name: str
+    calories_kcal: float  # required by the schema, so null here still fails validation
+    quantity: Optional[str] = None
+    protein_g: Optional[float] = 0
+    carbs_g: Optional[float] = 0
+    fat_g: Optional[float] = 0
+
+
+class Totals(_Macros):
+    calories_kcal: Optional[float] = 0
+    protein_g: Optional[float] = 0
+    carbs_g: Optional[float] = 0
+    fat_g: Optional[float] = 0
+
+
+class Plan(_Macros):
+    calories_kcal: Optional[float] = 0
+    protein_g: Optional[float] = 0
+    carbs_g: Optional[float] = 0
+    fat_g: Optional[float] = 0
+    notes: Optional[str] = None
+
+
+class Payload(msgspec.Struct):
+    kind: Literal["food_log", "macro_plan"]
+    items: Optional[List[Item]] = None
+    totals: Optional[Totals] = None
+    plan: Optional[Plan] = None
+    assumptions: Optional[str] = None
+
+
+_PAYLOAD_DECODER = msgspec.json.Decoder(Payload)
+
+SCHEMA_REMINDER = (
+    "Your previous answer did not match the nutrition_output schema. "
+    "Call nutrition_output once, with 'kind' set to 'food_log' or 'macro_plan', "
+    "and only use the fields and types the schema defines."
+)
+
+
+class NutritionSchemaError(Exception):
+    """The model's tool-call arguments parsed as JSON but failed schema validation."""
+
+
+def parse_payload(raw_text: str) -> Payload:
+    try:
+        return _PAYLOAD_DECODER.decode(raw_text)
+    except msgspec.ValidationError as e:
+        raise NutritionSchemaError(str(e)) from e
+    except msgspec.DecodeError:
+        # try a local repair (truncated output, trailing commas, ...) before another API round trip
+        repaired = json_repair.loads(raw_text)
+        if not isinstance(repaired, dict) or not repaired:
+            raise
+    try:
+        return msgspec.convert(repaired, Payload)
+    except msgspec.ValidationError as e:
+        raise NutritionSchemaError(str(e)) from e
+
+
+# Validated payloads keyed by normalized message text; common entries ("1 banana") recur a lot
+PROMPT_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=3600)
 
-    msg = resp.choices[0].message
-    if getattr(msg, "tool_calls", None):
+
+def _cache_key(user_text: str) -> str:
+    return " ".join(user_text.lower().split())
+
+
+def get_cached_payload(user_text: str) -> Optional[Payload]:
+    cached = PROMPT_CACHE.get(_cache_key(user_text))
+    # hand out a copy so callers can't mutate the cached entry
+    return copy.deepcopy(cached) if cached is not None else None
+
+
+# called synchronously from inside the stream loop, so it must not await Discord I/O
+PartialCallback = Callable[[Payload], None]
+
+
+async def _collect_tool_args(stream, on_partial: Optional[PartialCallback]) -> Tuple[str, str, bool]:
+    """Drain a streamed completion, returning (tool-call arguments, plain content, complete).
+
+    While arguments stream in, top-level keys are parsed incrementally and each
+    schema-valid partial payload is handed to ``on_partial``. If the stream breaks
+    off after some arguments arrived, what was buffered is returned with
+    ``complete=False`` instead of raising.
+    """
+    arg_parts: List[str] = []
+    content_parts: List[str] = []
+    partial: Dict[str, Any] = {}
+    events = ijson.sendable_list()
+    parser = ijson.kvitems_coro(events, "", use_float=True) if on_partial else None
+    complete = True
+
+    try:
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content_parts.append(delta.content)
+            if not delta.tool_calls or delta.tool_calls[0].function is None:
+                continue
+            fragment = delta.tool_calls[0].function.arguments
+            if not fragment:
+                continue
+            arg_parts.append(fragment)
+
+            if parser is None:
+                continue
+            try:
+                parser.send(fragment.encode())
+            except ijson.JSONError:
+                # stop parsing incrementally; the buffered text still goes through parse_payload
+                parser = None
+                continue
+            if events:
+                partial.update(events)
+                del events[:]
+                try:
+                    payload = msgspec.convert(partial, Payload)
+                except msgspec.ValidationError:
+                    continue
+                on_partial(payload)
+    except (httpx.HTTPError, APIError):
+        if not arg_parts:
+            raise
+        # keep what arrived; parse_payload can often repair a truncated object
+        logger.warning("OpenAI stream broke off; falling back to the buffered arguments", exc_info=True)
+        complete = False
+
+    return "".join(arg_parts), "".join(content_parts), complete
+
+
+async def call_openai_for_nutrition(
+    user_text: str, remind: bool = False, on_partial: Optional[PartialCallback] = None
+) -> Payload:
+    # callers check PROMPT_CACHE first (get_cached_payload); this only fills it
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if remind:
+        messages.append({"role": "system", "content": SCHEMA_REMINDER})
+    messages.append({"role": "user", "content": user_text})
+
+    async with OPENAI_SEM:
+        stream = await aclient.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            tools=NUTRITION_TOOLS,
+            tool_choice=NUTRITION_TOOL_CHOICE,
+            temperature=0.2,
+            stream=True,
+            # route requests sharing this tools + system prefix to the same prompt cache
+            prompt_cache_key="nutrition_tool_call",
+        )
+        args, text, complete = await _collect_tool_args(stream, on_partial)
+
+    if args:
         # arguments is a JSON string—parse it
-        args = msg.tool_calls[0].function.arguments
-        return json.loads(args)
+        payload = parse_payload(args)
+        # don't cache an answer repaired from a broken-off stream
+        if complete:
+            PROMPT_CACHE[_cache_key(user_text)] = copy.deepcopy(payload)
+        return payload
 
     # Fallback: no tool call (rare). Return something safe.
-    return {"kind": "food_log", "items": [], "totals": {}, "assumptions": msg.content or ""}
-
-
-def build_embed_from_payload(payload: Dict[str, Any], author: discord.Member) -> discord.Embed:
-    kind = payload.get("kind")
-    assumptions = payload.get("assumptions")
-    embed = discord.Embed(color=discord.Color.blurple())
-
-    if kind == "food_log":
-        embed.title = "Calories & Macros (Food Log)"
-        totals = payload.get("totals") or {}
-        embed.add_field(
-            name="Totals",
-            value=(
-                f"**Calories:** {totals.get('calories_kcal', 0):.0f} kcal\n"
-                f"**Protein:** {totals.get('protein_g', 0):.1f} g  "
-                f"**Carbs:** {totals.get('carbs_g', 0):.1f} g  "
-                f"**Fat:** {totals.get('fat_g', 0):.1f} g"
-            ),
-            inline=False,
-        )
-        items: List[Dict[str, Any]] = payload.get("items") or []
-        if items:
-            lines = []
-            for it in items[:20]:
-                q = f" — {it.get('quantity')}" if it.get("quantity") else ""
-                lines.append(
-                    f"• **{it.get('name','?')}**{q}: "
-                    f"{it.get('calories_kcal',0):.0f} kcal | "
-                    f"P {it.get('protein_g',0):.1f} • C {it.get('carbs_g',0):.1f} • F {it.get('fat_g',0):.1f}"
-                )
-            embed.add_field(name="Items", value="\n".join(lines), inline=False)
-
-    elif kind == "macro_plan":
-        embed.title = "Daily Macro Targets"
-        plan = payload.get("plan") or {}
-        embed.add_field(
-            name="Targets",
-            value=(
-                f"**Calories:** {plan.get('calories_kcal', 0):.0f} kcal/day\n"
-                f"**Protein:** {plan.get('protein_g', 0):.0f} g  "
-                f"**Carbs:** {plan.get('carbs_g', 0):.0f} g  "
-                f"**Fat:** {plan.get('fat_g', 0):.0f} g"
-            ),
-            inline=False,
+    return Payload(kind="food_log", assumptions=text)
+
+
+async def _fallback_call(txt: str) -> str:
+    async with OPENAI_SEM:
+        r = await aclient.responses.create(
+            model="gpt-4o-mini",
+            instructions=SYSTEM_PROMPT,
+            # a different prefix from the tool call (no tools, json_schema format), so its own key
+            prompt_cache_key="nutrition_fallback",
+            input=txt,
+            text=FALLBACK_TEXT_FORMAT,
         )
-        if plan.get("notes"):
-            embed.add_field(name="Notes", value=plan["notes"], inline=False)
+    return r.output_text
+
+
+_BLURPLE = discord.Color.blurple().value
+
+_ITEM_FMT = "• **{name}**{q}: {cals:.0f} kcal | P {p:.1f} • C {c:.1f} • F {f:.1f}".format
+# take a Totals / Plan positionally; missing fields already default to 0 on the struct
+_TOTALS_FMT = (
+    "**Calories:** {0.calories_kcal:.0f} kcal\n"
+    "**Protein:** {0.protein_g:.1f} g  "
+    "**Carbs:** {0.carbs_g:.1f} g  "
+    "**Fat:** {0.fat_g:.1f} g"
+).format
+_PLAN_FMT = (
+    "**Calories:** {0.calories_kcal:.0f} kcal/day\n"
+    "**Protein:** {0.protein_g:.0f} g  "
+    "**Carbs:** {0.carbs_g:.0f} g  "
+    "**Fat:** {0.fat_g:.0f} g"
+).format
+
 
-    else:
-        embed.title = "Nutrition Result"
-        embed.description = "I couldn't determine whether this was a food log or macro plan."
+def _fmt_item(it: Item) -> str:
+    return _ITEM_FMT(
+        name=it.name,
+        q=f" — {it.quantity}" if it.quantity else "",
+        cals=it.calories_kcal,
+        p=it.protein_g,
+        c=it.carbs_g,
+        f=it.fat_g,
+    )
+
+
+def build_embed_from_payload(payload: Payload, author: discord.Member) -> discord.Embed:
+    # assemble the embed's dict form once; Embed.from_dict skips the per-field add_field/setter calls
+    if payload.kind == "food_log":
+        title = "Calories & Macros (Food Log)"
+        fields = [{"name": "Totals", "value": _TOTALS_FMT(payload.totals or Totals()), "inline": False}]
+        if payload.items:
+            fields.append({"name": "Items", "value": "\n".join(map(_fmt_item, payload.items[:20])), "inline": False})
 
-    if assumptions:
-        embed.set_footer(text=f"Assumptions: {assumptions[:1900]}")
+    else:  # "macro_plan"; Payload.kind can't be anything else once decoded
+        title = "Daily Macro Targets"
+        plan = payload.plan or Plan()
+        fields = [{"name": "Targets", "value": _PLAN_FMT(plan), "inline": False}]
+        if plan.notes:
+            fields.append({"name": "Notes", "value": plan.notes, "inline": False})
 
-    embed.set_author(name=str(author), icon_url=getattr(author.avatar, "url", discord.Embed.Empty))
-    return embed
+    data: Dict[str, Any] = {
+        "title": title,
+        "color": _BLURPLE,
+        "fields": fields,
+        "author": {"name": str(author), "icon_url": author.display_avatar.url},
+    }
+    if payload.assumptions:
+        data["footer"] = {"text": f"Assumptions: {payload.assumptions[:1900]}"}
+    return discord.Embed.from_dict(data)
 
 @bot.event
 async def on_ready():
-    logging.info(f"Logged in as {bot.user} (id={bot.user.id})")
+    logger.info("Logged in as %s (id=%s)", bot.user, bot.user.id)
     if WATCH_CHANNEL_IDS:
-        logging.info(f"Watching channel IDs: {', '.join(map(str, WATCH_CHANNEL_IDS))}")
+        logger.info("Watching channel IDs: %s", sorted(WATCH_CHANNEL_IDS))
 
 @bot.event
 async def on_message(message: discord.Message):
+    # only act in the configured channels; most traffic is elsewhere, so check this first
+    if message.channel.id not in WATCH_CHANNEL_IDS:
+        return
     # ignore ourselves and other bots
     if message.author.bot:
         return
-    # only act in the configured channels
-    if WATCH_CHANNEL_IDS and message.channel.id not in WATCH_CHANNEL_IDS:
-        return
 
     # basic guard: skip empty messages
     content = (message.content or "").strip()
     if not content:
         return
+    # skip OpenAI entirely for emoji, punctuation and bare greetings
+    if CHATTER.fullmatch(content):
+        return
+
+    # cache hits answer immediately; skip the typing indicator and its heartbeat task
+    cached = get_cached_payload(content)
+    if cached is not None:
+        await message.reply(embed=build_embed_from_payload(cached, message.author), mention_author=False)
+        return
+
+    reply: Optional[discord.Message] = None
+    last_edit = 0.0
+
+    async def respond(**kwargs: Any) -> None:
+        # the first response is a reply; later ones edit it in place
+        nonlocal reply
+        if reply is None:
+            reply = await message.reply(mention_author=False, **kwargs)
+        else:
+            await reply.edit(**kwargs)
+
+    latest: Optional[Payload] = None  # newest partial not shown yet
+    renderer: Optional[asyncio.Task] = None
+    editing = False
+
+    async def render_partials() -> None:
+        # runs beside the stream, so Discord edits (and their rate-limit sleeps) never hold an OpenAI slot
+        nonlocal latest, last_edit, editing
+        while latest is not None:
+            wait = last_edit + EDIT_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            partial, latest = latest, None
+            last_edit = time.monotonic()
+            editing = True
+            try:
+                await respond(embed=build_embed_from_payload(partial, message.author))
+            except discord.HTTPException:
+                logger.warning("Partial embed update failed", exc_info=True)
+            finally:
+                editing = False
+
+    def show_partial(partial: Payload) -> None:
+        nonlocal latest, renderer
+        # wait for the section the embed is built around
+        if (partial.totals if partial.kind == "food_log" else partial.plan) is None:
+            return
+        latest = partial
+        if renderer is None or renderer.done():
+            renderer = asyncio.create_task(render_partials())
+
+    async def finish(**kwargs: Any) -> None:
+        # drop queued partials; an edit already in flight lands first so this one edits the same message
+        nonlocal latest
+        latest = None
+        if renderer is not None and not renderer.done():
+            if editing:
+                await renderer
+            else:
+                renderer.cancel()
+        await respond(**kwargs)
 
     try:
         async with message.channel.typing():
-            payload = await bot.loop.run_in_executor(None, call_openai_for_nutrition, content)
+            try:
+                payload = await call_openai_for_nutrition(content, on_partial=show_partial)
+            except NutritionSchemaError:
+                # retry once with a stricter reminder before paying for the free-text fallback
+                payload = await call_openai_for_nutrition(content, remind=True, on_partial=show_partial)
             embed = build_embed_from_payload(payload, message.author)
-        await message.reply(embed=embed, mention_author=False)
+        await finish(embed=embed)
 
-    except json.JSONDecodeError:
+    except (msgspec.DecodeError, NutritionSchemaError):
         try:
             async with message.channel.typing():
-                def _fallback_call(txt: str) -> str:
-                    r = client.responses.create(
-                        model="gpt-4o-mini",
-                        instructions=SYSTEM_PROMPT,
-                        input=txt,
-                    )
-                    return r.output_text
-                raw = await bot.loop.run_in_executor(None, _fallback_call, content)
-            await message.reply(raw[:1900], mention_author=False)
+                raw = await _fallback_call(content)
+            # an unparseable fallback reply ends in the apology below, never as raw JSON in the channel
+            embed = build_embed_from_payload(parse_payload(raw), message.author)
+            await finish(embed=embed)
         except Exception:
-            logging.exception("OpenAI fallback failed")
-            await message.reply("Sorry — I couldn't process that just now.", mention_author=False)
+            logger.exception("OpenAI fallback failed", extra={"channel_id": message.channel.id})
+            await finish(content="Sorry — I couldn't process that just now.", embed=None)
 
 
-    except Exception as e:
-        logging.exception("OpenAI call failed")
-        await message.reply("Sorry — I couldn't process that just now.", mention_author=False)
+    except Exception:
+        logger.exception("OpenAI call failed", extra={"channel_id": message.channel.id})
+        await finish(content="Sorry — I couldn't process that just now.", embed=None)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)